@@ -1,88 +1,247 @@
+import asyncio
+import hashlib
+import json
 import discord
 from discord.ext import commands
 from discord import app_commands
-import traceback
-from datetime import datetime
-from typing import Optional
+import logging
+import os
+from typing import Dict, Iterator, List, Optional
 from tracker import ReactionTracker
 import config
 
+log = logging.getLogger("reaction_tracker")
+
+DEFAULT_REPORT_EMOJI = "😹"  # Emoji /report filters by when none is given
+
+# Shortcodes typed into /report's emoji option, mapped to the stored unicode emoji
+EMOJI_ALIASES = {
+    ":joy_cat:": "😹",
+    ":joy:": "😂",
+    ":heart:": "❤️",
+    ":thumbsup:": "👍",
+    ":+1:": "👍",
+    ":fire:": "🔥",
+    ":skull:": "💀",
+}
+
+def _paginate(text: str, limit: int = 1900) -> Iterator[str]:
+    """Yield chunks of at most `limit` characters, breaking on line boundaries."""
+    buf: List[str] = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        if buf and size + len(line) > limit:
+            yield "".join(buf).rstrip("\n")
+            buf, size = [], 0
+        # A single line longer than a page is split at its last space that fits,
+        # so emoji and markup tokens stay whole where possible
+        while len(line) > limit:
+            cut = line.rfind(" ", 0, limit) + 1 or limit
+            yield line[:cut]
+            line = line[cut:]
+        buf.append(line)
+        size += len(line)
+    if buf:
+        yield "".join(buf).rstrip("\n")
+
 # Set up intents
 intents = discord.Intents.default()
 intents.reactions = True
-intents.messages = True
-intents.message_content = True
 intents.guilds = True
+intents.messages = False  # Message events and content aren't needed to track reactions
 
 # Bot class with slash command support
 class ReactionBot(commands.Bot):
+    # Signature of the last globally synced command tree, kept next to this module
+    tree_sig_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tree_sig")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._channel_name_cache: Dict[int, Dict[int, str]] = {}  # guild id -> channel id -> name
+
     async def setup_hook(self) -> None:
-        self.guilds_cache = {guild.id: await guild.fetch_channels() for guild in self.guilds}
+        # The owner never changes for a given token, so look it up once
+        self.owner_id = (await self.application_info()).owner.id
+        # Guilds aren't populated yet at this point; per-guild setup happens in on_guild_available
         try:
-            synced = await self.tree.sync()
-            print(f"Synced {len(synced)} slash command(s)")
-            
-            # Debug: Print guild information
-            print("Bot is connected to the following guilds:")
-            for guild in self.guilds:
-                print(f"  - {guild.name} (ID: {guild.id})")
-                
+            await self._sync_tree()
         except Exception as e:
-            print(f"Failed to sync commands: {e}")
+            log.error("Failed to sync commands: %s", e)
+
+    def _tree_signature(self) -> str:
+        """Hash the slash command payloads so an unchanged tree can skip syncing.
+
+        The application id is included so a signature left by another bot token can't suppress a sync.
+        """
+        payloads = sorted(
+            (command.to_dict(self.tree) for command in self.tree.get_commands()),
+            key=lambda payload: (payload.get("type", 1), payload["name"])
+        )
+        data = json.dumps([self.application_id, payloads], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
 
-bot = ReactionBot(command_prefix="$", intents=intents, help_command=None)  # Use uncommon prefix to avoid conflicts
+    async def _sync_tree(self) -> None:
+        """Sync slash commands to the dev guild, or globally only when they have changed."""
+        # Optional setting; configs from before it existed fall back to the environment (.env)
+        dev_guild_id = getattr(config, "DEV_GUILD_ID", None) or os.getenv("DEV_GUILD_ID")
+        if dev_guild_id:
+            # Guild commands propagate immediately, which is what you want while developing
+            guild = discord.Object(id=int(dev_guild_id))
+            self.tree.copy_global_to(guild=guild)
+            synced = await self.tree.sync(guild=guild)
+            log.info("Synced %s slash command(s) to dev guild %s", len(synced), dev_guild_id)
+            return
+
+        signature = self._tree_signature()
+        try:
+            with open(self.tree_sig_path) as f:
+                if f.read().strip() == signature:
+                    log.info("Slash commands unchanged, skipping sync")
+                    return
+        except OSError:
+            pass
+
+        synced = await self.tree.sync()
+        log.info("Synced %s slash command(s)", len(synced))
+        with open(self.tree_sig_path, "w") as f:
+            f.write(signature)
+
+    async def close(self) -> None:
+        """Disconnect first so no more events arrive, then flush pending reactions."""
+        try:
+            await super().close()
+        finally:
+            await reaction_tracker.close()
+
+bot = ReactionBot(command_prefix="$", intents=intents, help_command=None, max_messages=None)  # Use uncommon prefix to avoid conflicts
 reaction_tracker = ReactionTracker()
 
+# Static embeds are built once at import instead of on every command
+HELP_EMBED = discord.Embed(
+    title="🔧 Reaction Tracker Commands",
+    description="Use these slash commands to interact with the bot:",
+    color=discord.Color.blue()
+)
+HELP_EMBED.add_field(
+    name="📊 Main Commands",
+    value="`/report [days] [emoji]` - Get reaction statistics\n`/scan` - Start scanning message history\n`/emoji_stats [days]` - Show emoji usage statistics",
+    inline=False
+)
+HELP_EMBED.add_field(
+    name="⚙️ Control Commands", 
+    value="`/start` - Start tracking\n`/stop` - Stop tracking\n`/status` - Check status",
+    inline=False
+)
+HELP_EMBED.add_field(
+    name="🌟 Examples",
+    value="`/report` - Last 30 days of reactions\n`/report days:7` - All reactions from last week",
+    inline=False
+)
+
+SCAN_STARTED_EMBED = discord.Embed(
+    title="📊 Scanning Started",
+    description="Started scanning message history for reactions. This may take a while.",
+    color=discord.Color.blue()
+)
+
+SCAN_RUNNING_EMBED = discord.Embed(
+    title="⚠️ Scanning Already in Progress",
+    description="A scan is already running. Use `/scan_status` to check progress.",
+    color=discord.Color.orange()
+)
+
+SCAN_STOPPED_EMBED = discord.Embed(
+    title="🛑 Scanning Stopped",
+    description="Stopped scanning message history.",
+    color=discord.Color.red()
+)
+
+TRACKING_STARTED_EMBED = discord.Embed(
+    title="✅ Tracking Started",
+    description="Now tracking all reactions in this server!",
+    color=discord.Color.green()
+)
+
+TRACKING_STOPPED_EMBED = discord.Embed(
+    title="🛑 Tracking Stopped",
+    description="Reaction tracking has been stopped.",
+    color=discord.Color.red()
+)
+
 @bot.event
 async def on_ready():
     """Handle bot startup."""
     if bot.user:
-        print(f"Bot is ready! Logged in as {bot.user.name} ({bot.user.id})")
+        log.info("Bot is ready! Logged in as %s (%s)", bot.user.name, bot.user.id)
     else:
-        print("Bot is ready but user information is not available!")
-    print("-------------------")
+        log.warning("Bot is ready but user information is not available!")
     
-    for guild in bot.guilds:
-        print(f"Starting scan in guild: {guild.name}")
-        await reaction_tracker.start_background_scanning(guild)
+    # Start every guild's scan together rather than one after another
+    guilds = list(bot.guilds)
+    for guild in guilds:
+        log.info("Starting scan in guild: %s", guild.name)
+    results = await asyncio.gather(
+        *(reaction_tracker.start_background_scanning(guild) for guild in guilds),
+        return_exceptions=True
+    )
+    for guild, result in zip(guilds, results):
+        if isinstance(result, Exception):
+            log.error("Failed to start scan in guild %s: %s", guild.name, result)
     
     await bot.change_presence(activity=discord.Game(name="tracking reactions | /help"))
 
+@bot.event
+async def on_guild_available(guild):
+    """Cache channel names once a guild's data is available."""
+    log.info("Connected to guild: %s (ID: %s)", guild.name, guild.id)
+    bot._channel_name_cache[guild.id] = {channel.id: channel.name for channel in guild.channels}
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    """Drop a renamed channel's cached name."""
+    bot._channel_name_cache.get(after.guild.id, {}).pop(after.id, None)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Drop a deleted channel's cached name."""
+    bot._channel_name_cache.get(channel.guild.id, {}).pop(channel.id, None)
+
 @bot.event
 async def on_guild_join(guild):
     """Automatically start scanning when joining a new server."""
-    print(f"Joined new guild: {guild.name}")
+    log.info("Joined new guild: %s", guild.name)
     await reaction_tracker.start_background_scanning(guild)
 
 @bot.event
-async def on_reaction_add(reaction, user):
-    """Handle reaction events."""
-    if user.bot:
+async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    """Handle reaction events without relying on the message cache."""
+    if not reaction_tracker.tracking:
         return
+    # Reactions are tracked per guild, so ignore DMs
+    if payload.guild_id is None:
+        return
+    if payload.member and payload.member.bot:
+        return
+    
+    reactee_id = payload.message_author_id
+    if reactee_id is None:
+        # Discord normally sends the author with the event; only fetch the message when it doesn't
+        try:
+            message = await bot.get_partial_messageable(payload.channel_id).fetch_message(payload.message_id)
+        except discord.HTTPException as e:
+            log.warning("Could not resolve author of message %s: %s", payload.message_id, e)
+            return
+        reactee_id = message.author.id
     
-    message = reaction.message
     await reaction_tracker.track_reaction(
-        user.id,
-        message.author.id,
-        message.id,
-        message.channel.id,
-        message.guild.id,
-        str(reaction.emoji)
+        payload.user_id,
+        reactee_id,
+        payload.message_id,
+        payload.channel_id,
+        payload.guild_id,
+        str(payload.emoji)
     )
 
-@bot.event
-async def on_command_error(ctx, error):
-    """Handle command errors - we only use slash commands now, so ignore prefix command errors."""
-    # Since we only use slash commands, silently ignore all prefix command errors
-    if isinstance(error, commands.errors.CommandNotFound):
-        # Don't respond to unknown prefix commands
-        return
-    
-    # Log other errors but don't respond to user
-    if not isinstance(error, (commands.errors.CheckFailure, commands.errors.MissingRequiredArgument, commands.errors.BadArgument)):
-        print(f"Command error: {error}")
-        traceback.print_exception(type(error), error, error.__traceback__)
-
 # Global slash command error handler
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -95,8 +254,7 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
     except:
         pass
     
-    print(f"Slash command error: {error}")
-    traceback.print_exception(type(error), error, error.__traceback__)
+    log.error("Slash command error: %s", error, exc_info=error)
 
 # Simple test command
 @bot.tree.command(name="ping", description="Test if the bot is responding")
@@ -105,36 +263,16 @@ async def ping_slash(interaction: discord.Interaction):
     try:
         await interaction.response.send_message("🏓 Pong! Bot is working correctly.", ephemeral=True)
     except Exception as e:
-        print(f"Error in ping command: {e}")
+        log.error("Error in ping command: %s", e)
 
 # Slash Commands
 @bot.tree.command(name="help", description="Show help information about bot commands")
 async def show_help_slash(interaction: discord.Interaction):
     """Show help message."""
     try:
-        embed = discord.Embed(
-            title="🔧 Reaction Tracker Commands",
-            description="Use these slash commands to interact with the bot:",
-            color=discord.Color.blue()
-        )
-        embed.add_field(
-            name="📊 Main Commands",
-            value="`/report [days] [emoji]` - Get reaction statistics\n`/scan` - Start scanning message history\n`/emoji_stats [days]` - Show emoji usage statistics",
-            inline=False
-        )
-        embed.add_field(
-            name="⚙️ Control Commands", 
-            value="`/start` - Start tracking\n`/stop` - Stop tracking\n`/status` - Check status",
-            inline=False
-        )
-        embed.add_field(
-            name="🌟 Examples",
-            value="`/report` - Last 30 days of reactions\n`/report days:7` - All reactions from last week",
-            inline=False
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await interaction.response.send_message(embed=HELP_EMBED, ephemeral=True)
     except Exception as e:
-        print(f"Error in help command: {e}")
+        log.error("Error in help command: %s", e)
         if not interaction.response.is_done():
             await interaction.response.send_message("❌ Error displaying help", ephemeral=True)
 
@@ -147,21 +285,10 @@ async def scan_history_slash(interaction: discord.Interaction):
             return
             
         started = await reaction_tracker.start_scanning(interaction.guild)
-        if started:
-            embed = discord.Embed(
-                title="📊 Scanning Started",
-                description="Started scanning message history for reactions. This may take a while.",
-                color=discord.Color.blue()
-            )
-        else:
-            embed = discord.Embed(
-                title="⚠️ Scanning Already in Progress",
-                description="A scan is already running. Use `/scan_status` to check progress.",
-                color=discord.Color.orange()
-            )
+        embed = SCAN_STARTED_EMBED if started else SCAN_RUNNING_EMBED
         await interaction.response.send_message(embed=embed)
     except Exception as e:
-        print(f"Error in scan command: {e}")
+        log.error("Error in scan command: %s", e)
         if not interaction.response.is_done():
             await interaction.response.send_message("❌ Error starting scan", ephemeral=True)
 
@@ -172,7 +299,7 @@ async def scan_status_slash(interaction: discord.Interaction):
         await interaction.response.send_message("❌ This command can only be used in a server!", ephemeral=True)
         return
         
-    status = reaction_tracker.get_scan_status()
+    status = reaction_tracker.get_scan_status(interaction.guild.id)
     if status["scanning"]:
         embed = discord.Embed(
             title="📊 Scanning in Progress",
@@ -181,12 +308,17 @@ async def scan_status_slash(interaction: discord.Interaction):
         )
         
         channels_added = False
+        channel_names = bot._channel_name_cache.setdefault(interaction.guild.id, {})
         for channel_id, last_message_id in status["progress"].items():
-            channel = interaction.guild.get_channel(channel_id)
-            if channel:
+            name = channel_names.get(channel_id)
+            if name is None:
+                channel = interaction.guild.get_channel(channel_id)
+                if channel:
+                    name = channel_names[channel_id] = channel.name
+            if name:
                 channels_added = True
                 embed.add_field(
-                    name=f"📝 {channel.name}",
+                    name=f"📝 {name}",
                     value=f"Processing messages...\nLast message scanned: {last_message_id}",
                     inline=False
                 )
@@ -226,18 +358,17 @@ async def scan_status_slash(interaction: discord.Interaction):
 @bot.tree.command(name="scan_stop", description="Stop the scanning process")
 async def stop_scanning_slash(interaction: discord.Interaction):
     """Stop the scanning process."""
-    await reaction_tracker.stop_scanning()
-    embed = discord.Embed(
-        title="🛑 Scanning Stopped",
-        description="Stopped scanning message history.",
-        color=discord.Color.red()
-    )
-    await interaction.response.send_message(embed=embed)
+    if not interaction.guild:
+        await interaction.response.send_message("❌ This command can only be used in a server!", ephemeral=True)
+        return
+        
+    await reaction_tracker.stop_scanning(interaction.guild.id)
+    await interaction.response.send_message(embed=SCAN_STOPPED_EMBED)
 
 @bot.tree.command(name="report", description="Generate a detailed report of reactions")
 @app_commands.describe(
     days="Number of days to look back (default: 30)",
-    emoji="Emoji to filter by (default: 😹, use 'all' for all emojis)"
+    emoji=f"Emoji to filter by (default: {DEFAULT_REPORT_EMOJI}, use 'all' for all emojis)"
 )
 async def report_slash(interaction: discord.Interaction, days: Optional[int] = 30, emoji: Optional[str] = None):
     """Generate a detailed report of reactions."""
@@ -247,17 +378,23 @@ async def report_slash(interaction: discord.Interaction, days: Optional[int] = 3
     
     # Process emoji parameter
     if emoji is None:
-        emoji = "😹"
+        emoji = DEFAULT_REPORT_EMOJI
     elif emoji.lower() == "all":
         emoji = None
+    elif emoji.startswith(":") and emoji.endswith(":"):
+        emoji = EMOJI_ALIASES.get(emoji.lower(), emoji)
     
     report_text = await reaction_tracker.get_report(guild_id=interaction.guild.id, days=days, emoji=emoji, guild=interaction.guild, bot=bot)
     
     if len(report_text) > 2000:
-        parts = [report_text[i:i+1900] for i in range(0, len(report_text), 1900)]
-        await interaction.response.send_message(f"{parts[0]}\n(Part 1/{len(parts)})")
-        for i, part in enumerate(parts[1:], 2):
-            await interaction.followup.send(f"{part}\n(Part {i}/{len(parts)})")
+        parts = list(_paginate(report_text))  # Materialized once; every part is labelled with the total
+        total = len(parts)
+        await interaction.response.send_message(f"{parts[0]}\n(Part 1/{total})")
+        # Remaining parts are independent and labelled, so send them concurrently
+        await asyncio.gather(*(
+            interaction.followup.send(f"{part}\n(Part {i}/{total})")
+            for i, part in enumerate(parts[1:], 2)
+        ))
     else:
         await interaction.response.send_message(report_text)
 
@@ -269,7 +406,7 @@ async def emoji_stats_slash(interaction: discord.Interaction, days: Optional[int
         await interaction.response.send_message("❌ This command can only be used in a server!", ephemeral=True)
         return
         
-    stats = await reaction_tracker.get_emoji_stats(interaction.guild.id, days)
+    stats = await reaction_tracker.get_emoji_stats(interaction.guild.id, days, limit=10)
     
     if not stats:
         await interaction.response.send_message("No emoji statistics available for the specified timeframe!")
@@ -279,7 +416,7 @@ async def emoji_stats_slash(interaction: discord.Interaction, days: Optional[int
     if days:
         report.append(f"Time period: Last {days} days\n")
         
-    for emoji, count in list(stats.items())[:10]:
+    for emoji, count in stats.items():
         report.append(f"{emoji}: {count} uses")
         
     await interaction.response.send_message("\n".join(report))
@@ -288,23 +425,13 @@ async def emoji_stats_slash(interaction: discord.Interaction, days: Optional[int
 async def start_tracking_slash(interaction: discord.Interaction):
     """Start tracking reactions."""
     reaction_tracker.start_tracking()
-    embed = discord.Embed(
-        title="✅ Tracking Started",
-        description="Now tracking all reactions in this server!",
-        color=discord.Color.green()
-    )
-    await interaction.response.send_message(embed=embed)
+    await interaction.response.send_message(embed=TRACKING_STARTED_EMBED)
 
 @bot.tree.command(name="stop", description="Stop tracking reactions")
 async def stop_tracking_slash(interaction: discord.Interaction):
     """Stop tracking reactions."""
     reaction_tracker.stop_tracking()
-    embed = discord.Embed(
-        title="🛑 Tracking Stopped",
-        description="Reaction tracking has been stopped.",
-        color=discord.Color.red()
-    )
-    await interaction.response.send_message(embed=embed)
+    await interaction.response.send_message(embed=TRACKING_STOPPED_EMBED)
 
 @bot.tree.command(name="status", description="Check tracking status")
 async def status_slash(interaction: discord.Interaction):
@@ -326,61 +453,56 @@ async def debug_db_slash(interaction: discord.Interaction):
         return
         
     # Check if user is bot owner
-    app_info = await bot.application_info()
-    if interaction.user.id != app_info.owner.id:
+    if interaction.user.id != bot.owner_id:
         await interaction.response.send_message("❌ This command is only available to the bot owner.", ephemeral=True)
         return
     
-    stats = await reaction_tracker.db.get_statistics(guild_id=interaction.guild.id)
-    stats_list = list(stats)
+    stats = await reaction_tracker.db.get_overview(interaction.guild.id)
     
-    if not stats_list:
+    if not stats["total"]:
         await interaction.response.send_message("No reactions found in database!", ephemeral=True)
         return
-        
-    unique_emojis = set()
-    unique_users = set()
-    
-    for reaction in stats_list:
-        unique_emojis.add(reaction["emoji"])
-        unique_users.add(reaction["reactor_id"])
-        unique_users.add(reaction["reactee_id"])
     
     overview = [
         "📋 **Database Overview**",
-        f"Total reactions: {len(stats_list)}",
-        f"Unique emojis: {len(unique_emojis)}",
-        f"Users involved: {len(unique_users)}\n",
+        f"Total reactions: {stats['total']}",
+        f"Unique emojis: {stats['emojis']}",
+        f"Users involved: {stats['users']}\n",
         "Top 10 emojis:"
     ]
     
-    emoji_counts = {}
-    for reaction in stats_list:
-        emoji = reaction["emoji"]
-        emoji_counts[emoji] = emoji_counts.get(emoji, 0) + 1
-    
-    sorted_emojis = sorted(emoji_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-    for emoji, count in sorted_emojis:
+    for emoji, count in stats["top_emojis"]:
         overview.append(f"{emoji}: {count}")
     
     await interaction.response.send_message("\n".join(overview), ephemeral=True)
 
 # Run the bot
 if __name__ == "__main__":
+    # Prefer uvloop's libuv-based event loop when available (not supported on Windows)
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # One root handler for both discord.py and our own lazily formatted log lines
+    discord.utils.setup_logging(level=logging.INFO, root=True)
+
     if not config.TOKEN:
-        print("❌ Error: Bot token not found!")
-        print("Please create a .env file with your DISCORD_BOT_TOKEN")
-        print("Example: DISCORD_BOT_TOKEN=your_token_here")
+        log.error("❌ Error: Bot token not found!")
+        log.error("Please create a .env file with your DISCORD_BOT_TOKEN")
+        log.error("Example: DISCORD_BOT_TOKEN=your_token_here")
         raise ValueError("Bot token not found. Please set the DISCORD_BOT_TOKEN environment variable in .env file.")
     
-    print("🚀 Starting Discord Reaction Tracker Bot...")
-    print(f"📁 Database location: reactions.db")
-    print(f"⏰ Reaction timeframe: {config.REACTION_TIMEFRAME} seconds")
+    log.info("🚀 Starting Discord Reaction Tracker Bot...")
+    log.info("📁 Database location: reactions.db")
+    log.info("⏰ Reaction timeframe: %s seconds", config.REACTION_TIMEFRAME)
     
     try:
-        bot.run(config.TOKEN)
+        bot.run(config.TOKEN, log_handler=None)  # Logging is already configured above
     except discord.LoginFailure:
-        print("❌ Error: Invalid bot token. Please check your DISCORD_BOT_TOKEN in .env file.")
+        log.error("❌ Error: Invalid bot token. Please check your DISCORD_BOT_TOKEN in .env file.")
     except Exception as e:
-        print(f"❌ Error starting bot: {e}")
+        log.error("❌ Error starting bot: %s", e)
         raise
\ No newline at end of file
@@ -1,17 +1,45 @@
+import asyncio
+import logging
 import sqlite3
+import time
+from itertools import groupby
+from operator import itemgetter
 import aiosqlite
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-import os
+from typing import Optional, Dict, List, Any, Tuple, Callable, Set
+
+log = logging.getLogger("reaction_tracker")
+
+# (reactor_id, reactee_id, message_id, channel_id, guild_id, emoji, timestamp)
+ReactionRow = Tuple[int, int, int, int, int, str, datetime]
 
 class Database:
-    def __init__(self, db_path="reactions.db"):
+    batch_size = 500  # Maximum reactions written per transaction
+    batch_linger = 0.2  # Seconds a partial batch waits for more reactions before it is written
+    progress_interval = 5.0  # Seconds an idle writer waits before persisting scan progress
+
+    def __init__(self, db_path="reactions.db",
+                 on_write_error: Optional[Callable[[List[ReactionRow]], None]] = None):
         self.db_path = db_path
+        self.on_write_error = on_write_error  # Called with the rows of a batch that could not be written
+        # Queue and lock are created on first use, inside the running event loop: on
+        # Python < 3.10 they bind to whichever loop exists when they are constructed
+        self._queue: Optional[asyncio.Queue] = None  # Reactions waiting for the writer
+        self._writer_task: Optional[asyncio.Task] = None
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._read_conn: Optional[aiosqlite.Connection] = None
+        self._pending_progress: Dict[int, int] = {}  # Scan watermarks not yet written, by channel id
+        self._failed_channels: Set[int] = set()  # Channels whose watermark must not advance past a failed batch
+        self._lock: Optional[asyncio.Lock] = None  # Serializes transactions on the write connection; made in connect()
+        self._closed = False  # Set by close(); later writes are ignored instead of reopening the database
         self._init_db()
 
     def _init_db(self):
         """Initialize the database with required tables."""
         with sqlite3.connect(self.db_path) as conn:
+            # WAL turns commits into sequential appends; the mode is persisted in the file
+            conn.execute("PRAGMA journal_mode=WAL")
+
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS reactions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -30,34 +58,272 @@ class Database:
                 CREATE TABLE IF NOT EXISTS scan_progress (
                     channel_id INTEGER PRIMARY KEY,
                     last_message_id INTEGER,
-                    last_scan_time DATETIME
+                    last_scan_time INTEGER  -- Unix time in milliseconds
                 )
             """)
             
             # Create indexes for better query performance
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON reactions(timestamp)")
+            # Queries always filter by guild first, then by time window and optionally emoji;
+            # the composite index also covers the old timestamp-only index. It is partial so
+            # removed reactions never enter it and the is_removed filter comes for free.
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_active_guild_time_emoji ON reactions(guild_id, timestamp, emoji)
+                WHERE is_removed = FALSE
+            """)
+            conn.execute("DROP INDEX IF EXISTS idx_timestamp")
+
+            # A reaction is unique per message, user and emoji so re-scans can't double count.
+            # Databases created before this index may already hold duplicates; keep the first copy.
+            has_unique_index = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uq_reaction'"
+            ).fetchone()
+            if not has_unique_index:
+                conn.execute("""
+                    DELETE FROM reactions WHERE id NOT IN (
+                        SELECT MIN(id) FROM reactions GROUP BY message_id, reactor_id, emoji
+                    )
+                """)
+                conn.execute("CREATE UNIQUE INDEX uq_reaction ON reactions(message_id, reactor_id, emoji)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_reactor ON reactions(reactor_id)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_reactee ON reactions(reactee_id)")
 
+    async def _open(self) -> aiosqlite.Connection:
+        """Open a connection with the per-connection PRAGMAs applied."""
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute("PRAGMA mmap_size=268435456")
+        await conn.execute("PRAGMA cache_size=-65536")
+        return conn
+
+    async def connect(self) -> aiosqlite.Connection:
+        """Open the shared write connection on first use and return it."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._conn is None:
+            conn = await self._open()
+            # Another coroutine may have connected while we awaited
+            if self._conn is None:
+                self._conn = conn
+            else:
+                await conn.close()
+        return self._conn
+
+    async def _reader(self) -> aiosqlite.Connection:
+        """Open the shared read connection on first use and return it.
+
+        With WAL, reads on their own connection see the last commit instead of
+        waiting for the writer's open transaction.
+        """
+        if self._closed:
+            raise RuntimeError("Database is closed")
+        if self._read_conn is None:
+            conn = await self._open()
+            # Reads only: an accidental write here fails instead of contending with the writer
+            await conn.execute("PRAGMA query_only=ON")
+            if self._read_conn is None:
+                self._read_conn = conn
+            else:
+                await conn.close()
+        return self._read_conn
+
     async def add_reaction(self, reactor_id: int, reactee_id: int, message_id: int,
                           channel_id: int, guild_id: int, emoji: str, timestamp: Optional[datetime] = None):
-        """Add a new reaction to the database."""
+        """Queue a new reaction for the background writer, returning whether it was queued.
+
+        Never waits on the queue: this runs on the gateway event path, so when the writer
+        has fallen behind and the queue is full the reaction is dropped and logged instead.
+        """
         if timestamp is None:
             timestamp = datetime.now()
 
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO reactions 
-                (timestamp, reactor_id, reactee_id, message_id, channel_id, guild_id, emoji)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (timestamp, reactor_id, reactee_id, message_id, channel_id, guild_id, emoji))
-            await db.commit()
+        if not self._ensure_writer():
+            return False
+        try:
+            self._queue.put_nowait((reactor_id, reactee_id, message_id, channel_id, guild_id, emoji, timestamp))
+        except asyncio.QueueFull:
+            log.warning("Write queue full, dropping reaction on message %s", message_id)
+            return False
+        return True
+
+    async def add_reactions_bulk(self, rows: List[ReactionRow]):
+        """Queue many reactions for the background writer.
+
+        Each row is (reactor_id, reactee_id, message_id, channel_id, guild_id, emoji, timestamp).
+        Returns whether the rows were queued.
+        """
+        if not self._ensure_writer():
+            return False
+        for row in rows:
+            await self._queue.put(row)
+        return True
+
+    def _ensure_writer(self) -> bool:
+        """Start the background writer on first use (or if it has died).
 
-    async def get_reactions(self, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+        Returns False once the database is closed, so late writes are dropped rather
+        than starting a writer and connection that nothing would close.
+        """
+        if self._closed:
+            log.warning("Database is closed, dropping write")
+            return False
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=10_000)
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.create_task(self._writer_loop())
+        return True
+
+    async def _writer_loop(self):
+        """Write queued reactions in batches over one long-lived connection."""
+        await self.connect()
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # Block for the first row, then keep collecting until the batch is full
+            # or has lingered long enough, so bursts share one transaction
+            try:
+                rows = [await asyncio.wait_for(self._queue.get(), timeout=self.progress_interval)]
+            except asyncio.TimeoutError:
+                rows = []
+            deadline = loop.time() + self.batch_linger
+            while rows and len(rows) < self.batch_size:
+                try:
+                    rows.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Watermarks are set after their message's reactions were queued, so they
+            # are only safe to persist once nothing is left waiting behind this batch
+            progress = self._take_progress() if self._queue.empty() else {}
+            if not rows and not progress:
+                continue
+
+            try:
+                await self._write_batch(rows, progress)
+            except Exception as e:
+                log.error("Error writing %s reaction(s): %s", len(rows), e)
+                self._discard_failed(rows, progress)
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def _discard_failed(self, rows: List[ReactionRow], progress: Dict[int, int]):
+        """Make sure a batch that failed to write gets scanned again rather than skipped over.
+
+        Its channels stop advancing their watermark until they are next scanned from the
+        stored one, and watermarks for other channels are put back for the next batch.
+        """
+        failed_channels = {row[3] for row in rows}
+        self._failed_channels |= failed_channels
+        for channel_id in failed_channels:
+            self._pending_progress.pop(channel_id, None)
+        for channel_id, message_id in progress.items():
+            if channel_id not in failed_channels:
+                self._pending_progress.setdefault(channel_id, message_id)
+        if rows and self.on_write_error:
+            self.on_write_error(rows)
+
+    def _take_progress(self) -> Dict[int, int]:
+        """Hand over the pending scan watermarks, leaving none pending."""
+        progress, self._pending_progress = self._pending_progress, {}
+        return progress
+
+    async def _write_batch(self, rows: List[ReactionRow], progress: Dict[int, int]):
+        """Insert a batch of reactions and scan watermarks in a single transaction."""
+        async with self._lock:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if rows:
+                    await self._conn.executemany("""
+                        INSERT OR IGNORE INTO reactions 
+                        (reactor_id, reactee_id, message_id, channel_id, guild_id, emoji, timestamp)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+                if progress:
+                    now = int(time.time() * 1000)
+                    await self._conn.executemany("""
+                        INSERT OR REPLACE INTO scan_progress (channel_id, last_message_id, last_scan_time)
+                        VALUES (?, ?, ?)
+                    """, [(channel_id, message_id, now) for channel_id, message_id in progress.items()])
+                await self._conn.execute("COMMIT")
+            except Exception:
+                await self._conn.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        """Wait until every queued reaction and pending scan watermark has been written."""
+        if self._writer_task and not self._writer_task.done():
+            await self._queue.join()
+        if self._pending_progress:
+            await self.connect()
+            await self._write_batch([], self._take_progress())
+
+    async def close(self):
+        """Flush queued reactions, then stop the writer and close both connections."""
+        await self.flush()
+        self._closed = True
+        if self._writer_task:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        if self._conn:
+            async with self._lock:
+                await self._conn.close()
+                self._conn = None
+        if self._read_conn:
+            await self._read_conn.close()
+            self._read_conn = None
+
+    async def get_reactions(self, guild_id: int, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
                           emoji: Optional[str] = None):
-        """Get reactions within a time range and/or for a specific emoji."""
-        query = "SELECT * FROM reactions WHERE is_removed = FALSE"
-        params = []
+        """Get a guild's reactions within a time range and/or for a specific emoji."""
+        where, params = self._filters(guild_id, start_time, end_time, emoji)
+        return await self._fetch("SELECT * FROM reactions" + where, params)
+
+    async def update_scan_progress(self, channel_id: int, last_message_id: int):
+        """Update the scanning progress for a channel.
+
+        The watermark is kept in memory and written alongside the next batch of reactions.
+        It is ignored while an earlier batch for the channel has failed to write.
+        """
+        if channel_id in self._failed_channels or not self._ensure_writer():
+            return
+        self._pending_progress[channel_id] = last_message_id
+
+    async def get_scan_progress(self, channel_id: int):
+        """Get the last scanned message ID for a channel.
+
+        Call this when starting a scan: resuming from the stored watermark re-covers any
+        failed batch, so the channel's watermark may advance again afterwards.
+        """
+        self._failed_channels.discard(channel_id)
+        if channel_id in self._pending_progress:
+            return self._pending_progress[channel_id]
+
+        conn = await self._reader()
+        async with conn.execute(
+            "SELECT last_message_id FROM scan_progress WHERE channel_id = ?",
+            (channel_id,)
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
+
+    def _filters(self, guild_id: int, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+                 emoji: Optional[str] = None):
+        """Build the WHERE clause and parameters shared by the statistics queries."""
+        query = " WHERE is_removed = FALSE AND guild_id = ?"
+        params: List[Any] = [guild_id]
 
         if start_time:
             query += " AND timestamp >= ?"
@@ -69,34 +335,85 @@ class Database:
             query += " AND emoji = ?"
             params.append(emoji)
 
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = sqlite3.Row
-            async with db.execute(query, params) as cursor:
-                return await cursor.fetchall()
+        return query, params
 
-    async def update_scan_progress(self, channel_id: int, last_message_id: int):
-        """Update the scanning progress for a channel."""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT OR REPLACE INTO scan_progress (channel_id, last_message_id, last_scan_time)
-                VALUES (?, ?, ?)
-            """, (channel_id, last_message_id, datetime.now()))
-            await db.commit()
+    async def _fetch(self, query: str, params: List[Any]):
+        """Run a read query on the read connection and return all rows."""
+        conn = await self._reader()
+        async with conn.execute(query, params) as cursor:
+            return await cursor.fetchall()
 
-    async def get_scan_progress(self, channel_id: int):
-        """Get the last scanned message ID for a channel."""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT last_message_id FROM scan_progress WHERE channel_id = ?",
-                (channel_id,)
-            ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else None
+    async def _get_top_users(self, user_column: str, guild_id: int, start_time: Optional[datetime] = None,
+                             emoji: Optional[str] = None, limit: int = 5, top_emojis: int = 3):
+        """Get (user_id, count, [(emoji, count), ...]) for the users with the most reactions in `user_column`.
+
+        Each user's `top_emojis` most used emojis are included only when not filtering by emoji.
+        """
+        where, params = self._filters(guild_id, start_time, emoji=emoji)
+        query = f"""
+            SELECT {user_column} AS user_id, COUNT(*) AS count
+            FROM reactions
+            {where}
+            GROUP BY {user_column}
+            ORDER BY count DESC, user_id
+            LIMIT ?
+        """
+        rows = await self._fetch(query, params + [limit])
+
+        breakdown: Dict[int, List[Tuple[str, int]]] = {}
+        if rows and not emoji and top_emojis:
+            emoji_rows = await self._get_user_emojis(
+                user_column, guild_id, [user_id for user_id, _ in rows], start_time, top_emojis)
+            breakdown = {
+                user_id: [(e, count) for _, e, count in user_rows]
+                for user_id, user_rows in groupby(emoji_rows, key=itemgetter(0))
+            }
+        return [(user_id, count, breakdown.get(user_id, [])) for user_id, count in rows]
+
+    async def _get_user_emojis(self, user_column: str, guild_id: int, user_ids: List[int],
+                               start_time: Optional[datetime] = None, top: int = 3):
+        """Get (user_id, emoji, count) rows for each given user's `top` emojis, most used first per user."""
+        where, params = self._filters(guild_id, start_time)
+        placeholders = ", ".join("?" * len(user_ids))
+        query = f"""
+            SELECT user_id, emoji, count FROM (
+                SELECT {user_column} AS user_id, emoji, COUNT(*) AS count,
+                       ROW_NUMBER() OVER (PARTITION BY {user_column} ORDER BY COUNT(*) DESC, emoji) AS rank
+                FROM reactions
+                {where} AND {user_column} IN ({placeholders})
+                GROUP BY {user_column}, emoji
+            )
+            WHERE rank <= ?
+            ORDER BY user_id, rank
+        """
+        return await self._fetch(query, params + list(user_ids) + [top])
+
+    async def get_top_reactors(self, guild_id: int, start_time: Optional[datetime] = None,
+                               emoji: Optional[str] = None, limit: int = 5):
+        """Get the users who gave the most reactions, with their most used emojis."""
+        return await self._get_top_users("reactor_id", guild_id, start_time, emoji, limit)
+
+    async def get_top_reactees(self, guild_id: int, start_time: Optional[datetime] = None,
+                               emoji: Optional[str] = None, limit: int = 5):
+        """Get the users who received the most reactions, with their most received emojis."""
+        return await self._get_top_users("reactee_id", guild_id, start_time, emoji, limit)
+
+    async def get_emoji_counts(self, guild_id: int, start_time: Optional[datetime] = None, limit: Optional[int] = None):
+        """Get (emoji, count) rows, most used first."""
+        where, params = self._filters(guild_id, start_time)
+        query = """
+            SELECT emoji, COUNT(*) AS count
+            FROM reactions
+        """ + where + " GROUP BY emoji ORDER BY count DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return await self._fetch(query, params)
 
     async def get_statistics(self, guild_id: int, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
                            emoji: Optional[str] = None):
-        """Get comprehensive reaction statistics."""
-        
+        """Get (reactor_id, reactee_id, emoji, count) statistics rows."""
+        where, params = self._filters(guild_id, start_time, end_time, emoji)
         query = """
             SELECT 
                 reactor_id,
@@ -104,24 +421,28 @@ class Database:
                 emoji,
                 COUNT(*) as count
             FROM reactions
-            WHERE is_removed = FALSE AND guild_id = ?
-        """
-        params: List[Any] = [guild_id]
+        """ + where + " GROUP BY reactor_id, reactee_id, emoji"
+        return await self._fetch(query, params)
 
-        if start_time:
-            query += " AND timestamp >= ?"
-            params.append(start_time)
-        if end_time:
-            query += " AND timestamp <= ?"
-            params.append(end_time)
-        if emoji:
-            query += " AND emoji = ?"
-            params.append(emoji)
-
-        query += " GROUP BY reactor_id, reactee_id, emoji"
-        
-
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = sqlite3.Row
-            async with db.execute(query, params) as cursor:
-                return await cursor.fetchall()
\ No newline at end of file
+    async def get_overview(self, guild_id: int, top: int = 10) -> Dict[str, Any]:
+        """Get reaction totals for a guild, aggregated entirely in SQLite."""
+        where, params = self._filters(guild_id)
+        query = f"""
+            SELECT
+                COUNT(*),
+                COUNT(DISTINCT emoji),
+                (SELECT COUNT(*) FROM (
+                    SELECT reactor_id FROM reactions {where}
+                    UNION
+                    SELECT reactee_id FROM reactions {where}
+                ))
+            FROM reactions
+            {where}
+        """
+        (total, emojis, users), = await self._fetch(query, params * 3)
+        return {
+            "total": total,
+            "emojis": emojis,
+            "users": users,
+            "top_emojis": await self.get_emoji_counts(guild_id, limit=top),
+        }
@@ -0,0 +1,31 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Async token bucket: allows `burst` calls at once, refilling at `rate` calls per second."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None  # Made on first use, inside the running event loop
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a token is available, then take it."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Waiters queue on the lock so tokens are handed out in arrival order
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
@@ -1,26 +1,41 @@
 from datetime import datetime, timedelta
-from collections import defaultdict
-from typing import Optional, Dict, List, Any, DefaultDict
+from collections import defaultdict, OrderedDict
+from typing import Optional, Dict, List, Any, DefaultDict, Tuple
 import asyncio
+import logging
+import time
 import discord
-from database import Database
+from database import Database, ReactionRow
+from rate_limit import TokenBucket
 import config
 
+log = logging.getLogger("reaction_tracker")
+
 class ReactionTracker:
+    scan_concurrency = 8  # Channels scanned at once per guild
+    recent_cache_size = 200_000  # Recently tracked reactions remembered to skip duplicates
+    report_cache_ttl = 60  # Seconds a generated report or emoji summary is reused
+    channel_rate = 1.0  # Scan requests per second per channel (Discord allows ~5 per 5s per route)
+    channel_burst = 5
+    global_rate = 50  # Scan requests per second across all channels (Discord's global limit)
+    progress_checkpoint = 100  # Messages scanned between scan progress checkpoints
+    max_reaction_retries = 3  # Retries of a rate limited reaction before the channel scan gives up
+
     def __init__(self):
-        self.db = Database()
-        self.scanning = False
-        self.scan_progress: DefaultDict[int, int] = defaultdict(int)
-        self.scan_task: Optional[asyncio.Task] = None
-        self.reactions: List[Dict[str, Any]] = []  # In-memory storage for reactions
+        self.db = Database(on_write_error=self._forget)
+        self.scan_progress: Dict[int, Dict[int, int]] = {}  # guild id -> channel id -> last scanned message id
         self.tracking = True  # Tracking state
-        self.retry_delay = 60  # Initial retry delay in seconds
         self.max_retry_delay = 3600  # Maximum retry delay (1 hour)
-        self.rate_limit_hits: DefaultDict[int, int] = defaultdict(int)  # Track rate limit hits per channel
-        self._background_task: Optional[asyncio.Task] = None
+        self.rate_limit_hits: Dict[int, int] = {}  # Track rate limit hits per channel
+        self._report_cache: Dict[tuple, Tuple[float, Any]] = {}  # key -> (monotonic time stored, result)
+        self._recent: OrderedDict = OrderedDict()  # (message_id, reactor_id, emoji) keys, oldest first
+        self._background_tasks: Dict[int, asyncio.Task] = {}  # One background scan per guild
+        self._fetch_semaphore: Optional[asyncio.Semaphore] = None  # Caps concurrent channel fetches across guilds; made on first use
+        self._global_bucket = TokenBucket(self.global_rate, self.global_rate)
+        # Per-channel request budgets while scanning, created on first use
+        self._channel_buckets: DefaultDict[int, TokenBucket] = defaultdict(
+            lambda: TokenBucket(self.channel_rate, self.channel_burst))
         # Use configurable delays
-        self.base_delay = config.MESSAGE_DELAY  # Base delay between messages
-        self.reaction_delay = config.REACTION_DELAY  # Delay between processing each reaction
         self.channel_delay = config.CHANNEL_DELAY  # Delay between processing channels
         self.min_rate_limit_delay = config.MIN_RATE_LIMIT_DELAY  # Minimum rate limit delay
         
@@ -35,7 +50,10 @@ class ReactionTracker:
     async def track_reaction(self, reactor_id: int, reactee_id: int, message_id: int, 
                            channel_id: int, guild_id: int, emoji: str, timestamp: Optional[datetime] = None):
         """Track a new reaction."""
-        await self.db.add_reaction(
+        key = (message_id, reactor_id, emoji)
+        if self._is_recent(key):
+            return
+        queued = await self.db.add_reaction(
             reactor_id=reactor_id,
             reactee_id=reactee_id,
             message_id=message_id,
@@ -44,90 +62,155 @@ class ReactionTracker:
             emoji=emoji,
             timestamp=timestamp
         )
+        if queued:
+            self._remember(key)
+
+    async def track_reactions_bulk(self, rows: List[ReactionRow]):
+        """Track many reactions at once, in the same field order as track_reaction."""
+        rows = [row for row in rows if not self._is_recent((row[2], row[0], row[5]))]
+        if rows and await self.db.add_reactions_bulk(rows):
+            for row in rows:
+                self._remember((row[2], row[0], row[5]))
+
+    def _is_recent(self, key: Tuple[int, int, str]) -> bool:
+        """Check whether a reaction was queued recently.
+
+        The database ignores duplicates anyway; this just skips queuing them again.
+        """
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            return True
+        return False
+
+    def _remember(self, key: Tuple[int, int, str]) -> None:
+        """Remember a reaction once it has been queued for writing."""
+        self._recent[key] = None
+        if len(self._recent) > self.recent_cache_size:
+            self._recent.popitem(last=False)
 
-    async def scan_channel_history(self, channel: discord.TextChannel, guild_id: Optional[int] = None, progress_callback=None):
+    def _forget(self, rows: List[ReactionRow]) -> None:
+        """Forget reactions whose write failed so they can be tracked again."""
+        for row in rows:
+            self._recent.pop((row[2], row[0], row[5]), None)
+
+    def _rate_limit_delay(self, error: discord.HTTPException, retry_count: int) -> float:
+        """Seconds to wait after a 429: Discord's Retry-After, else capped exponential backoff."""
+        retry_after = error.response.headers.get("Retry-After") if error.response is not None else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return max(self.min_rate_limit_delay, min(self.min_rate_limit_delay * (2 ** retry_count), self.max_retry_delay))
+
+    async def _throttle(self, channel_id: int):
+        """Wait until both the channel's and the global request budget allow another call."""
+        await self._channel_buckets[channel_id].acquire()
+        await self._global_bucket.acquire()
+
+    async def close(self):
+        """Stop scanning and write out any queued reactions."""
+        await self.stop_scanning()
+        await self.db.close()
+
+    async def scan_channel_history(self, channel: discord.TextChannel, guild_id: Optional[int] = None):
         """Scan a channel's message history for reactions."""
         # Strict type checking
         if not isinstance(channel, discord.TextChannel):
-            print(f"Error: Expected TextChannel object, got {type(channel)} for {channel}")
+            log.error("Error: Expected TextChannel object, got %s for %s", type(channel), channel)
             return
             
         # Ensure we have a valid guild_id
         if guild_id is None:
             if not hasattr(channel, 'guild'):
-                print(f"Error: Channel {channel.name} has no guild attribute")
+                log.error("Error: Channel %s has no guild attribute", channel.name)
                 return
             guild_id = channel.guild.id
         
         last_message_id = await self.db.get_scan_progress(channel.id)
-        retry_count = self.rate_limit_hits[channel.id]
-        current_delay = min(self.retry_delay * (2 ** retry_count), self.max_retry_delay)
         
         # Convert message ID to discord.Object if we have one
         after_object = discord.Object(id=last_message_id) if last_message_id else None
         
+        channel_id = channel.id
+        guild_progress = self.scan_progress.setdefault(guild_id, {})
+        self.rate_limit_hits.setdefault(channel_id, 0)
+        scanned = 0
+        last_scanned: Optional[int] = None  # Newest message whose reactions are fully queued
         try:
-            async for message in channel.history(limit=None, after=after_object):
-                if not self.scanning:
-                    break
-                    
-                # Add base delay between processing messages
-                await asyncio.sleep(self.base_delay)
+            # Stopping a scan cancels its guild's task, which ends this loop
+            async for message in channel.history(limit=None, after=after_object, oldest_first=True):
+                # history() requests 100 messages at a time; charge one token per page
+                if scanned % 100 == 0:
+                    await self._throttle(channel_id)
+                scanned += 1
                     
+                # Fields shared by every row from this message
+                author_id = message.author.id
+                message_id = message.id
+                created_at = message.created_at
+                rows: List[ReactionRow] = []
                 for reaction in message.reactions:
-                    try:
-                        # Add delay before fetching reaction users
-                        await asyncio.sleep(self.reaction_delay)
-                        
-                        async for user in reaction.users():
-                            if user.bot:
-                                continue
-                                
-                            await self.track_reaction(
-                                user.id,
-                                message.author.id,
-                                message.id,
-                                channel.id,
-                                guild_id,
-                                str(reaction.emoji),
-                                message.created_at
-                            )
-                            
-                            # Successful request, reduce retry count gradually
-                            if self.rate_limit_hits[channel.id] > 0:
-                                self.rate_limit_hits[channel.id] = max(0, self.rate_limit_hits[channel.id] - 1)
-                            
-                    except discord.errors.HTTPException as e:
-                        if e.code == 429:  # Rate limit hit
-                            print(f"Rate limit hit for channel {channel.name}, increasing delay...")
-                            self.rate_limit_hits[channel.id] += 1
-                            retry_count = self.rate_limit_hits[channel.id]
-                            # Calculate exponential backoff with reasonable minimum
-                            delay = max(self.min_rate_limit_delay, min(self.min_rate_limit_delay * (2 ** retry_count), self.max_retry_delay))
-                            print(f"Waiting {delay} seconds before retrying...")
+                    # Nothing to fetch if no one is left, or the bot is the only reactor
+                    if reaction.count == 0 or (reaction.count == 1 and reaction.me):
+                        continue
+                    emoji_str = str(reaction.emoji)
+                    # Retry a rate limited reaction from its first page, or give up on the channel
+                    # (the watermark stays before this message, so the next scan picks it up)
+                    for attempt in range(self.max_reaction_retries + 1):
+                        reaction_rows: List[ReactionRow] = []
+                        try:
+                            await self._throttle(channel_id)
+                            fetched = 0
+                            async for user in reaction.users():
+                                # users() requests 100 reactors at a time; charge a token before each further page
+                                fetched += 1
+                                if fetched % 100 == 0 and fetched < reaction.count:
+                                    await self._throttle(channel_id)
+                                if user.bot:
+                                    continue
+                                    
+                                reaction_rows.append((user.id, author_id, message_id, channel_id, guild_id, emoji_str, created_at))
+                        except discord.errors.HTTPException as e:
+                            if e.status != 429 or attempt == self.max_reaction_retries:
+                                raise
+                            log.warning("Rate limit hit for channel %s, increasing delay...", channel.name)
+                            self.rate_limit_hits[channel_id] += 1
+                            delay = self._rate_limit_delay(e, self.rate_limit_hits[channel_id])
+                            log.warning("Waiting %s seconds before retrying...", delay)
                             await asyncio.sleep(delay)
                             continue
-                        raise
+
+                        rows.extend(reaction_rows)
+                        # Successful request, reduce retry count gradually
+                        if self.rate_limit_hits[channel_id] > 0:
+                            self.rate_limit_hits[channel_id] -= 1
+                        break
                 
-                await self.db.update_scan_progress(channel.id, message.id)
-                self.scan_progress[channel.id] = message.id
+                # Queue the whole message at once; the writer batches it into one transaction
+                if rows:
+                    await self.track_reactions_bulk(rows)
+                last_scanned = guild_progress[channel_id] = message_id
+                if scanned % self.progress_checkpoint == 0:
+                    await self.db.update_scan_progress(channel_id, last_scanned)
                 
         except discord.errors.Forbidden:
-            print(f"No access to channel {channel.name}")
+            log.warning("No access to channel %s", channel.name)
         except Exception as e:
-            print(f"Error scanning channel {channel.name}: {e}")
+            log.error("Error scanning channel %s: %s", channel.name, e)
+        finally:
+            # Record how far we got, even if the scan was stopped or failed part way
+            if last_scanned is not None:
+                await self.db.update_scan_progress(channel_id, last_scanned)
 
     async def start_background_scanning(self, guild: discord.Guild):
         """Start the background scanning process."""
         if not isinstance(guild, discord.Guild):
-            print(f"Error: Expected Guild object, got {type(guild)}")
+            log.error("Error: Expected Guild object, got %s", type(guild))
             return False
             
-        if self._background_task and not self._background_task.done():
+        if self.is_scanning(guild.id):
             return False  # Already running
             
-        self.scanning = True
-        self._background_task = asyncio.create_task(self._background_scan_loop(guild))
+        self._background_tasks[guild.id] = asyncio.create_task(self._background_scan_loop(guild))
         return True
         
     async def _background_scan_loop(self, guild: discord.Guild):
@@ -136,78 +219,115 @@ class ReactionTracker:
             try:
                 # Ensure we have a valid guild object
                 if not isinstance(guild, discord.Guild):
-                    print(f"Error: Expected Guild object, got {type(guild)}")
+                    log.error("Error: Expected Guild object, got %s", type(guild))
                     return
                 
-                # Fetch and filter text channels
-                try:
-                    channels = await guild.fetch_channels()
-                    text_channels = [
-                        channel for channel in channels 
-                        if isinstance(channel, discord.TextChannel)
-                    ]
-                except Exception as e:
-                    print(f"Error fetching channels for guild {guild.name}: {e}")
-                    await asyncio.sleep(300)  # Wait 5 minutes before retry
-                    continue
-                
-                # Process each text channel
-                for channel in text_channels:
-                    if not self.scanning:
-                        return
-                    
-                    if not isinstance(channel, discord.TextChannel):
-                        print(f"Warning: Skipping invalid channel type: {type(channel)}")
-                        continue
-                        
+                # The gateway keeps the guild's channel cache current; only ask the API
+                # when the cache is empty (e.g. the guild is not fully loaded yet)
+                text_channels = guild.text_channels
+                if not text_channels:
                     try:
-                        await self.scan_channel_history(channel, guild.id)
-                        # Add configurable delay between channels to prevent overwhelming the API
-                        await asyncio.sleep(self.channel_delay)
+                        if self._fetch_semaphore is None:
+                            self._fetch_semaphore = asyncio.Semaphore(4)
+                        async with self._fetch_semaphore:
+                            channels = await guild.fetch_channels()
+                        text_channels = [
+                            channel for channel in channels 
+                            if isinstance(channel, discord.TextChannel)
+                        ]
                     except Exception as e:
-                        print(f"Error scanning {channel.name}: {e}")
+                        log.error("Error fetching channels for guild %s: %s", guild.name, e)
+                        await asyncio.sleep(300)  # Wait 5 minutes before retry
                         continue
+                
+                # Scan channels in parallel; Discord rate limits message history per channel
+                semaphore = asyncio.BoundedSemaphore(self.scan_concurrency)
+
+                async def scan_channel(channel: discord.TextChannel):
+                    async with semaphore:
+                        try:
+                            await self.scan_channel_history(channel, guild.id)
+                            # Add configurable delay before this worker takes the next channel
+                            await asyncio.sleep(self.channel_delay)
+                        except Exception as e:
+                            log.error("Error scanning %s: %s", channel.name, e)
+
+                await asyncio.gather(*(scan_channel(channel) for channel in text_channels))
                         
                 # All channels scanned, wait before next cycle
                 await asyncio.sleep(3600)  # Wait an hour between full scans
                 
             except Exception as e:
-                print(f"Background scan error: {e}")
+                log.error("Background scan error: %s", e)
                 await asyncio.sleep(300)  # Wait 5 minutes on error
                 continue
     
     async def start_scanning(self, guild: discord.Guild):
         """Start scanning the server's message history."""
-        if self.scanning:
-            return False
+        return await self.start_background_scanning(guild)
         
-        await self.start_background_scanning(guild)
-        return True
-        
-    async def stop_scanning(self):
-        """Stop the scanning process."""
-        self.scanning = False
-        if self._background_task:
-            self._background_task.cancel()
-            try:
-                await self._background_task
-            except asyncio.CancelledError:
-                pass
-            self._background_task = None
+    def is_scanning(self, guild_id: int) -> bool:
+        """Check whether a guild's background scan is running."""
+        task = self._background_tasks.get(guild_id)
+        return task is not None and not task.done()
 
-    def get_scan_status(self):
-        """Get the current scanning status."""
+    async def stop_scanning(self, guild_id: Optional[int] = None):
+        """Stop a guild's scan, or every guild's scan when no guild is given."""
+        if guild_id is None:
+            tasks = list(self._background_tasks.values())
+            self._background_tasks.clear()
+        else:
+            task = self._background_tasks.pop(guild_id, None)
+            tasks = [task] if task else []
+        for task in tasks:
+            task.cancel()
+        # The final watermarks are left to the background writer (and to close()), so
+        # stopping does not wait for the whole write queue to drain
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_scan_status(self, guild_id: int):
+        """Get the current scanning status for a guild."""
         return {
-            "scanning": self.scanning,
-            "progress": dict(self.scan_progress)
+            "scanning": self.is_scanning(guild_id),
+            "progress": dict(self.scan_progress.get(guild_id, {}))
         }
 
+    def _get_cached(self, key: tuple) -> Any:
+        """Return a cached result that is still fresh, or None."""
+        entry = self._report_cache.get(key)
+        if entry and time.monotonic() - entry[0] < self.report_cache_ttl:
+            return entry[1]
+        return None
+
+    def _set_cached(self, key: tuple, value: Any) -> None:
+        """Cache a result, dropping expired entries."""
+        now = time.monotonic()
+        self._report_cache = {
+            k: entry for k, entry in self._report_cache.items()
+            if now - entry[0] < self.report_cache_ttl
+        }
+        self._report_cache[key] = (now, value)
+
+    @staticmethod
+    def _window_start(days: Optional[int]) -> Optional[datetime]:
+        """Start of a `days` long window ending now, floored to the minute so nearby requests share a cache entry."""
+        if not days:
+            return None
+        return (datetime.now() - timedelta(days=days)).replace(second=0, microsecond=0)
+
     async def get_report(self, guild_id: int, days: Optional[int] = None, emoji: Optional[str] = None, guild=None, bot=None) -> str:
+        """Generate a detailed report of reaction statistics, reusing one built within the TTL."""
+        start_time = self._window_start(days)
+        key = ("report", guild_id, days, start_time, emoji)
+        report = self._get_cached(key)
+        if report is None:
+            report = await self._build_report(guild_id, days, emoji, guild, bot, start_time)
+            self._set_cached(key, report)
+        return report
+
+    async def _build_report(self, guild_id: int, days: Optional[int] = None, emoji: Optional[str] = None, guild=None, bot=None,
+                            start_time: Optional[datetime] = None) -> str:
         """Generate a detailed report of reaction statistics."""
-        start_time = None
-        if days:
-            start_time = datetime.now() - timedelta(days=days)
-        
         async def get_username(user_id: int) -> str:
             """Helper function to get username or fallback to ID."""
             if guild:
@@ -225,107 +345,59 @@ class ReactionTracker:
                         pass
             return f"User#{user_id}"
 
-        report_lines: List[str] = []
-
-        stats = await self.db.get_statistics(guild_id=guild_id, start_time=start_time, emoji=emoji)
-        if not stats:
+        # Let SQLite do the grouping and ranking; only the top users and their top emojis come back
+        top_reactors = await self.db.get_top_reactors(guild_id, start_time=start_time, emoji=emoji)
+        if not top_reactors:
             return "No reactions found for the specified criteria!"
+        top_reactees = await self.db.get_top_reactees(guild_id, start_time=start_time, emoji=emoji)
 
-        # Process statistics
-        reactor_stats: Dict[int, Dict[str, Any]] = {}
-        reactee_stats: Dict[int, Dict[str, Any]] = {}
-
-        for row in stats:
-            reactor_id = row["reactor_id"]
-            reactee_id = row["reactee_id"]
-            emoji = row["emoji"]
-            count = row["count"]
+        # Resolve every name up front so any fetch_user round trips overlap
+        user_ids = list(dict.fromkeys(user_id for user_id, _, _ in top_reactors + top_reactees))
+        names = dict(zip(user_ids, await asyncio.gather(*(get_username(user_id) for user_id in user_ids))))
 
-            # Initialize if not exists
-            if reactor_id not in reactor_stats:
-                reactor_stats[reactor_id] = {"given": 0, "emojis": {}}
-            if reactee_id not in reactee_stats:
-                reactee_stats[reactee_id] = {"received": 0, "emojis": {}}
-
-            # Update stats
-            reactor_stats[reactor_id]["given"] += count
-            reactor_stats[reactor_id]["emojis"][emoji] = reactor_stats[reactor_id]["emojis"].get(emoji, 0) + count
-            
-            reactee_stats[reactee_id]["received"] += count
-            reactee_stats[reactee_id]["emojis"][emoji] = reactee_stats[reactee_id]["emojis"].get(emoji, 0) + count
+        def user_lines(top_users, verb: str, label: str) -> List[str]:
+            if emoji:
+                # When filtering by emoji, just show the count
+                return [
+                    line
+                    for i, (user_id, count, _) in enumerate(top_users, 1)
+                    for line in (f"{i}. {names[user_id]}: {count} {emoji}", "")
+                ]
+            # Show detailed breakdown only when not filtering by emoji
+            return [
+                line
+                for i, (user_id, count, top_emojis) in enumerate(top_users, 1)
+                for line in (
+                    f"{i}. {names[user_id]}: {count} reactions {verb}",
+                    f"   {label}: " + " ".join(f"{e}({c})" for e, c in top_emojis),
+                    "",
+                )
+            ]
 
         # Build report
         report_lines = ["📊 **Reaction Tracking Report**"]
-        
         if days:
             report_lines.append(f"Time period: Last {days} days")
         if emoji:
             report_lines.append(f"Filtered by emoji: {emoji}")
         report_lines.append("")
-
-        # Top 5 reaction givers
         report_lines.append("**🎯 Top 5 Reaction Givers:**")
-        sorted_reactors = sorted(
-            [(uid, data) for uid, data in reactor_stats.items()],
-            key=lambda x: x[1]["given"],
-            reverse=True
-        )[:5]  # Always show top 5
-
-        for i, (user_id, stats) in enumerate(sorted_reactors, 1):
-            username = await get_username(user_id)
-            if emoji:
-                # When filtering by emoji, just show the count
-                report_lines.append(f"{i}. {username}: {stats['given']} {emoji}")
-            else:
-                # Show detailed breakdown only when not filtering by emoji
-                top_emojis = sorted(
-                    stats["emojis"].items(),
-                    key=lambda x: x[1],
-                    reverse=True
-                )[:3]
-                emoji_str = " ".join(f"{emoji}({count})" for emoji, count in top_emojis)
-                report_lines.append(f"{i}. {username}: {stats['given']} reactions given")
-                report_lines.append(f"   Most used: {emoji_str}")
-            report_lines.append("")
-
-        # Top 5 reaction receivers
+        report_lines.extend(user_lines(top_reactors, "given", "Most used"))
         report_lines.append("**🎯 Top 5 Reaction Receivers:**")
-        sorted_reactees = sorted(
-            [(uid, data) for uid, data in reactee_stats.items()],
-            key=lambda x: x[1]["received"],
-            reverse=True
-        )[:5]  # Always show top 5
-
-        for i, (user_id, stats) in enumerate(sorted_reactees, 1):
-            username = await get_username(user_id)
-            if emoji:
-                # When filtering by emoji, just show the count
-                report_lines.append(f"{i}. {username}: {stats['received']} {emoji}")
-            else:
-                # Show detailed breakdown only when not filtering by emoji
-                top_emojis = sorted(
-                    stats["emojis"].items(),
-                    key=lambda x: x[1],
-                    reverse=True
-                )[:3]
-                emoji_str = " ".join(f"{emoji}({count})" for emoji, count in top_emojis)
-                report_lines.append(f"{i}. {username}: {stats['received']} reactions received")
-                report_lines.append(f"   Most received: {emoji_str}")
-            report_lines.append("")
+        report_lines.extend(user_lines(top_reactees, "received", "Most received"))
 
         return "\n".join(report_lines)
 
-    async def get_emoji_stats(self, guild_id: int, days: Optional[int] = None):
-        """Get statistics about emoji usage."""
-        start_time = None
-        if days:
-            start_time = datetime.now() - timedelta(days=days)
-
-        stats = await self.db.get_statistics(guild_id=guild_id, start_time=start_time)
-        
-        emoji_stats = defaultdict(int)
-        for row in stats:
-            emoji_stats[row["emoji"]] += row["count"]
+    async def get_emoji_stats(self, guild_id: int, days: Optional[int] = None, limit: Optional[int] = None):
+        """Get statistics about emoji usage, most used first."""
+        start_time = self._window_start(days)
+        key = ("emoji_stats", guild_id, start_time, limit)
+        stats = self._get_cached(key)
+        if stats is not None:
+            return stats
 
-        return dict(sorted(emoji_stats.items(), key=lambda x: x[1], reverse=True))
+        rows = await self.db.get_emoji_counts(guild_id, start_time=start_time, limit=limit)
+        stats = dict(rows)
+        self._set_cached(key, stats)
+        return stats
         